@@ -9,14 +9,19 @@
 # - Constructs W3C compliant traceparent: 00-{trace_id}-{parent_id}-01
 # ============================================================================
 
-import json
 import time
 import random
 import os
+import threading
+from itertools import accumulate
 from kafka import KafkaProducer
+from kafka.codec import has_lz4
+import orjson
 from datetime import datetime, timezone
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
+from dataclasses import dataclass
+from contextlib import nullcontext
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -24,8 +29,13 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # ELASTIC APM INITIALIZATION - MUST BE FIRST
 # ============================================================================
 from elasticapm import Client
+from elasticapm.traces import execution_context
 import elasticapm
 
+# Head-based sampling: the client decides at begin_transaction() whether a
+# transaction is recorded. Unsampled sends skip labels and trace propagation.
+TRANSACTION_SAMPLE_RATE = float(os.environ.get('ELASTIC_APM_TRANSACTION_SAMPLE_RATE', '0.05'))
+
 # Initialize the APM Client (documented API)
 apm_client = Client({
     'SERVICE_NAME': os.environ.get('ELASTIC_APM_SERVICE_NAME', 'iccp-simulator'),
@@ -34,7 +44,7 @@ apm_client = Client({
     'ENVIRONMENT': os.environ.get('ELASTIC_APM_ENVIRONMENT', 'production'),
     'SERVICE_VERSION': '2.3.2',
     'VERIFY_SERVER_CERT': False,
-    'TRANSACTION_SAMPLE_RATE': float(os.environ.get('ELASTIC_APM_TRANSACTION_SAMPLE_RATE', '1.0')),
+    'TRANSACTION_SAMPLE_RATE': TRANSACTION_SAMPLE_RATE,
     'SPAN_FRAMES_MIN_DURATION': '5ms',
     'TRANSACTION_MAX_SPANS': 100,
     'CAPTURE_BODY': 'off',
@@ -47,11 +57,96 @@ elasticapm.instrument()
 # ============================================================================
 # LOGGING CONFIGURATION
 # ============================================================================
+# Unknown LOG_LEVEL values fall back to INFO instead of failing at startup
+REQUESTED_LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVEL_VALID = isinstance(logging.getLevelName(REQUESTED_LOG_LEVEL), int)
+
 logging.basicConfig(
-    level=logging.INFO,
+    level=REQUESTED_LOG_LEVEL if LOG_LEVEL_VALID else 'INFO',
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+if not LOG_LEVEL_VALID:
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", REQUESTED_LOG_LEVEL)
+
+# Number of messages' worth of random values drawn per pool refill
+RANDOM_POOL_SIZE = 4096
+
+# Kafka topic per message type
+TOPIC_MAP = {
+    'STATUS_POINT': 'iccp-status-points',
+    'ANALOG_VALUE': 'iccp-analog-values',
+    'PROTECTION_EVENT': 'iccp-protection-events',
+    'ENERGY_ACCOUNTING': 'iccp-energy-accounting'
+}
+
+# Fixed message vocabulary
+PROTOCOL_VERSION = 'IEC60870-6-503'
+UNITS_MW = 'MW'
+QUALITIES = ('GOOD', 'UNCERTAIN', 'INVALID')
+CB_VOLTAGES = ('330', '220', '110')
+CB_VOLTAGE_NAMES = ('330kV', '220kV', '110kV')
+MW_KINDS = ('GEN', 'LOAD', 'FLOW')
+MW_NAMES = ('Generation', 'Load', 'Power Flow')
+EVENT_TYPES = ('OVERCURRENT', 'UNDERVOLTAGE', 'FREQUENCY_DEVIATION', 'LINE_FAULT')
+SEVERITIES = ('LOW', 'MEDIUM', 'HIGH', 'CRITICAL')
+
+# Message type mix, with cumulative weights precomputed for random.choices
+MESSAGE_TYPES = ['STATUS_POINT', 'ANALOG_VALUE', 'PROTECTION_EVENT', 'ENERGY_ACCOUNTING']
+MESSAGE_TYPE_CUM_WEIGHTS = list(accumulate([50, 30, 15, 5]))
+
+# Site-specific configuration, keyed by SITE_NAME. Shared read-only by all
+# simulator instances.
+SITES_CONFIG = {
+    "auckland-penrose": {
+        "site_id": "AKL_PENROSE",
+        "display_name": "Auckland Penrose 330kV",
+        "lat": -36.8485,
+        "lon": 174.7633,
+        "customers": ["CONTACT_ENERGY", "MERCURY_ENERGY", "GENESIS_ENERGY"],
+        "message_frequency": 1.5
+    },
+    "wellington-central": {
+        "site_id": "WLG_CENTRAL",
+        "display_name": "Wellington Central 220kV",
+        "lat": -41.2865,
+        "lon": 174.7762,
+        "customers": ["MERCURY_ENERGY", "GENESIS_ENERGY"],
+        "message_frequency": 2.0
+    },
+    "christchurch-addington": {
+        "site_id": "CHC_ADDINGTON",
+        "display_name": "Christchurch Addington 66kV",
+        "lat": -43.5321,
+        "lon": 172.6362,
+        "customers": ["MERIDIAN_ENERGY", "CONTACT_ENERGY"],
+        "message_frequency": 1.8
+    },
+    "huntly-power": {
+        "site_id": "HUNTLY_POWER",
+        "display_name": "Huntly Power Station",
+        "lat": -37.5483,
+        "lon": 175.0681,
+        "customers": ["GENESIS_ENERGY"],
+        "message_frequency": 0.8
+    },
+    "manapouri-power": {
+        "site_id": "MANAPOURI_POWER",
+        "display_name": "Manapouri Power Station",
+        "lat": -45.5361,
+        "lon": 167.1761,
+        "customers": ["MERIDIAN_ENERGY"],
+        "message_frequency": 1.0
+    }
+}
+
+@dataclass
+class SendContext:
+    """APM transaction state handed from a send to its delivery callbacks"""
+    transaction: Any
+    topic: str
+    message_type: str
+    message_number: int
 
 # ============================================================================
 # ICCP SIMULATOR CLASS
@@ -67,8 +162,40 @@ class ICCPSimulator:
         self.site_name = os.environ.get('SITE_NAME', 'auckland-penrose')
         self.pod_name = os.environ.get('POD_NAME', 'unknown')
         
+        # Throughput mode: send BATCH_MESSAGES messages per APM transaction, no delay
+        self.batch_mode = os.environ.get('BATCH_MODE', '0') == '1'
+        self.batch_messages = int(os.environ.get('BATCH_MESSAGES', '100'))
+        
+        # Upper bound on sends awaiting a broker ack in per-message mode
+        self._inflight = threading.Semaphore(int(os.environ.get('MAX_INFLIGHT_SENDS', '64')))
+        
         self.site_config = self.load_site_config()
         self.message_counter = 0
+        
+        # Per-site message fields that never change after startup
+        site_id = self.site_config['site_id']
+        self._region = site_id.split('_')[0]
+        self._location = {
+            'lat': self.site_config['lat'],
+            'lon': self.site_config['lon'],
+            'region': self._region
+        }
+        self._assoc_by_customer = {
+            customer: f'{site_id}-{customer}-01'
+            for customer in self.site_config['customers']
+        }
+        self._templates = self._build_message_templates()
+        self._static_prefix = self._build_static_prefixes()
+        
+        self._refill_random_pool()
+        
+        # Message type -> generator (ENERGY_ACCOUNTING reuses the status point shape)
+        self._generators = {
+            'STATUS_POINT': self.generate_status_point_message,
+            'ANALOG_VALUE': self.generate_analog_value_message,
+            'PROTECTION_EVENT': self.generate_protection_event_message,
+            'ENERGY_ACCOUNTING': self.generate_status_point_message
+        }
         self.producer = self.create_kafka_producer()
         
         logger.info("="*70)
@@ -77,311 +204,487 @@ class ICCPSimulator:
         logger.info(f"Site: {self.site_config['site_id']}")
         logger.info(f"Kafka: {self.kafka_brokers}")
         logger.info(f"APM: {os.environ.get('ELASTIC_APM_SERVER_URL', 'Not configured')}")
-        logger.info(f"Sampling: {os.environ.get('ELASTIC_APM_TRANSACTION_SAMPLE_RATE', '1.0')}")
+        logger.info(f"Sampling: {TRANSACTION_SAMPLE_RATE}")
         logger.info(f"Pod: {self.pod_name}")
         logger.info(f"Distributed Tracing: ENABLED (manual traceparent)")
         logger.info("="*70)
 
     def load_site_config(self) -> Dict[str, Any]:
-        """Load site-specific configuration"""
-        sites_config = {
-            "auckland-penrose": {
-                "site_id": "AKL_PENROSE",
-                "display_name": "Auckland Penrose 330kV",
-                "lat": -36.8485,
-                "lon": 174.7633,
-                "customers": ["CONTACT_ENERGY", "MERCURY_ENERGY", "GENESIS_ENERGY"],
-                "message_frequency": 1.5
-            },
-            "wellington-central": {
-                "site_id": "WLG_CENTRAL",
-                "display_name": "Wellington Central 220kV",
-                "lat": -41.2865,
-                "lon": 174.7762,
-                "customers": ["MERCURY_ENERGY", "GENESIS_ENERGY"],
-                "message_frequency": 2.0
-            },
-            "christchurch-addington": {
-                "site_id": "CHC_ADDINGTON",
-                "display_name": "Christchurch Addington 66kV",
-                "lat": -43.5321,
-                "lon": 172.6362,
-                "customers": ["MERIDIAN_ENERGY", "CONTACT_ENERGY"],
-                "message_frequency": 1.8
-            },
-            "huntly-power": {
-                "site_id": "HUNTLY_POWER",
-                "display_name": "Huntly Power Station",
-                "lat": -37.5483,
-                "lon": 175.0681,
-                "customers": ["GENESIS_ENERGY"],
-                "message_frequency": 0.8
-            },
-            "manapouri-power": {
-                "site_id": "MANAPOURI_POWER",
-                "display_name": "Manapouri Power Station",
-                "lat": -45.5361,
-                "lon": 167.1761,
-                "customers": ["MERIDIAN_ENERGY"],
-                "message_frequency": 1.0
-            }
-        }
-        return sites_config.get(self.site_name, sites_config["auckland-penrose"])
+        """Load site-specific configuration (falls back to auckland-penrose)"""
+        return SITES_CONFIG.get(self.site_name, SITES_CONFIG["auckland-penrose"])
     
     def create_kafka_producer(self) -> KafkaProducer:
         """Initialize Kafka producer with compression"""
-        compression = os.environ.get('KAFKA_COMPRESSION_TYPE', 'gzip')
+        # lz4 compresses JSON at a similar ratio to gzip for a fraction of the
+        # CPU; needs the 'lz4' package (or 'zstandard' for zstd, Kafka 2.1+)
+        compression = os.environ.get('KAFKA_COMPRESSION_TYPE', 'lz4')
         compression_codec = None if compression.lower() == 'none' or not compression else compression
+        if compression_codec == 'lz4' and not has_lz4():
+            # KafkaProducer refuses to start without the codec library
+            logger.warning("⚠ lz4 library not installed - falling back to gzip compression")
+            compression_codec = 'gzip'
         logger.info(f"Kafka compression: '{compression_codec}'")
         
+        # linger_ms only helps when several sends are in flight (batch mode, or
+        # a busy site); at one message every ~1.5s it just delays each send.
+        # Batch mode defaults to a short linger and larger record batches so a
+        # whole batch can coalesce.
+        linger_ms = int(os.environ.get('KAFKA_LINGER_MS', '10' if self.batch_mode else '0'))
+        batch_size = int(os.environ.get('KAFKA_BATCH_SIZE', '409600' if self.batch_mode else '16384'))
+        logger.info(f"Kafka linger_ms: {linger_ms}, batch_size: {batch_size}")
+        
         return KafkaProducer(
             bootstrap_servers=self.kafka_brokers,
-            value_serializer=lambda x: json.dumps(x, default=str).encode('utf-8'),
+            value_serializer=None,  # messages are pre-encoded by _encode_message
             retry_backoff_ms=1000,
             retries=5,
             acks='all',
             compression_type=compression_codec,
-            linger_ms=10,
-            batch_size=16384
+            linger_ms=linger_ms,
+            batch_size=batch_size,
+            # Sends are asynchronous; bound what can queue up behind the broker
+            max_in_flight_requests_per_connection=5,
+            buffer_memory=8 * 1024 * 1024
         )
     
+    def _build_message_templates(self) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """
+        Build the fields that are fixed per (customer, message_type).
+        Generators shallow-copy these and add the variable fields; the shared
+        location dict is only ever read.
+        """
+        templates = {}
+        for customer, association in self._assoc_by_customer.items():
+            for message_type in ('STATUS_POINT', 'ANALOG_VALUE', 'PROTECTION_EVENT'):
+                templates[(customer, message_type)] = {
+                    'site_id': self.site_config['site_id'],
+                    'site_name': self.site_config['display_name'],
+                    'customer_id': customer,
+                    'message_type': message_type,
+                    'iccp_association': association,
+                    'location': self._location
+                }
+        return templates
+    
+    def _build_static_prefixes(self) -> Dict[Tuple[str, str], bytes]:
+        """
+        Pre-serialize each message template as an open JSON object,
+        ready to have the variable fields appended.
+        """
+        return {
+            key: orjson.dumps(template)[:-1] + b','
+            for key, template in self._templates.items()
+        }
+    
+    def _encode_message(self, message: Dict[str, Any]) -> bytes:
+        """Serialize a message as its cached static prefix plus the variable fields"""
+        variable = orjson.dumps({
+            'timestamp': message['timestamp'],
+            'data': message['data'],
+            'metadata': message['metadata']
+        })
+        return self._static_prefix[(message['customer_id'], message['message_type'])] + variable[1:]
+    
+    def _refill_random_pool(self, size: int = RANDOM_POOL_SIZE):
+        """
+        Pre-draw a batch of random values for the message generators.
+        Each generated message consumes one index across all columns, so
+        the per-call RNG and cumulative-weight overhead is paid once per batch.
+        Two- and three-way weighted draws use plain threshold comparisons,
+        which are cheaper than random.choices' bisect lookup.
+        """
+        choices = random.choices
+        rand = random.random
+        good, uncertain, invalid = QUALITIES
+        self._pool = {
+            # STATUS_POINT
+            'cb_kv': choices(CB_VOLTAGES, k=size),
+            'cb_kv_name': choices(CB_VOLTAGE_NAMES, k=size),
+            'cb_value': choices([0, 1], k=size),
+            'status_quality': [
+                good if r < 0.92 else uncertain if r < 0.98 else invalid
+                for r in [rand() for _ in range(size)]
+            ],
+            'change_counter': choices(range(1000, 10000), k=size),
+            'association_active': [rand() < 0.98 for _ in range(size)],
+            # ANALOG_VALUE
+            'mw_kind': choices(MW_KINDS, k=size),
+            'mw_name': choices(MW_NAMES, k=size),
+            'mw_value': [round(random.uniform(50.0, 500.0), 2) for _ in range(size)],
+            'analog_quality': [
+                good if r < 0.94 else uncertain if r < 0.99 else invalid
+                for r in [rand() for _ in range(size)]
+            ],
+            # PROTECTION_EVENT
+            'event_id': choices(range(10000, 100000), k=size),
+            'event_type': choices(EVENT_TYPES, k=size),
+            'severity': choices(SEVERITIES, cum_weights=[40, 75, 95, 100], k=size),
+            'cleared': [rand() < 0.85 for _ in range(size)],
+            'event_size': choices(range(200, 601), k=size),
+            'event_roundtrip': choices(range(8, 31), k=size),
+            # Shared
+            'line': choices(range(1, 5), k=size),
+            'line_name': choices(range(1, 5), k=size),
+            'message_size': choices(range(128, 513), k=size),
+            'roundtrip': choices(range(5, 26), k=size),
+        }
+        self._pool_size = size
+        self._pool_index = 0
+    
+    def _next_pool_index(self) -> int:
+        """Claim the next row of pre-drawn random values, refilling when exhausted"""
+        if self._pool_index >= self._pool_size:
+            self._refill_random_pool()
+        i = self._pool_index
+        self._pool_index = i + 1
+        return i
+    
     def generate_status_point_message(self, customer: str) -> Dict[str, Any]:
         """Generate STATUS_POINT message (Circuit Breaker status)"""
         self.message_counter += 1
+        pool = self._pool
+        i = self._next_pool_index()
         
-        return {
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'site_id': self.site_config['site_id'],
-            'site_name': self.site_config['display_name'],
-            'customer_id': customer,
-            'message_type': 'STATUS_POINT',
-            'iccp_association': f'{self.site_config["site_id"]}-{customer}-01',
-            'data': {
-                'point_id': f'CB_{random.choice(["330", "220", "110"])}_L{random.randint(1,4)}_STATUS',
-                'point_name': f'Circuit Breaker {random.choice(["330kV", "220kV", "110kV"])} Line {random.randint(1,4)}',
-                'value': random.choice([0, 1]),
-                'quality': random.choices(['GOOD', 'UNCERTAIN', 'INVALID'], weights=[92, 6, 2])[0],
-                'timestamp': datetime.now(timezone.utc).isoformat(),
-                'change_counter': random.randint(1000, 9999)
-            },
-            'location': {
-                'lat': self.site_config['lat'],
-                'lon': self.site_config['lon'],
-                'region': self.site_config['site_id'].split('_')[0]
-            },
-            'metadata': {
-                'protocol_version': 'IEC60870-6-503',
-                'message_size': random.randint(128, 512),
-                'association_active': random.choices([True, False], weights=[98, 2])[0],
-                'roundtrip_time_ms': random.randint(5, 25),
-                'message_number': self.message_counter
-            }
+        message = self._templates[(customer, 'STATUS_POINT')].copy()
+        message['timestamp'] = datetime.now(timezone.utc).isoformat()
+        message['data'] = {
+            'point_id': f'CB_{pool["cb_kv"][i]}_L{pool["line"][i]}_STATUS',
+            'point_name': f'Circuit Breaker {pool["cb_kv_name"][i]} Line {pool["line_name"][i]}',
+            'value': pool['cb_value'][i],
+            'quality': pool['status_quality'][i],
+            'change_counter': pool['change_counter'][i]
+        }
+        message['metadata'] = {
+            'protocol_version': PROTOCOL_VERSION,
+            'message_size': pool['message_size'][i],
+            'association_active': pool['association_active'][i],
+            'roundtrip_time_ms': pool['roundtrip'][i],
+            'message_number': self.message_counter
         }
+        
+        return message
     
     def generate_analog_value_message(self, customer: str) -> Dict[str, Any]:
         """Generate ANALOG_VALUE message (Power measurements)"""
         self.message_counter += 1
+        pool = self._pool
+        i = self._next_pool_index()
         
-        return {
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'site_id': self.site_config['site_id'],
-            'site_name': self.site_config['display_name'],
-            'customer_id': customer,
-            'message_type': 'ANALOG_VALUE',
-            'iccp_association': f'{self.site_config["site_id"]}-{customer}-01',
-            'data': {
-                'point_id': f'MW_{random.choice(["GEN", "LOAD", "FLOW"])}_L{random.randint(1,4)}',
-                'point_name': f'{random.choice(["Generation", "Load", "Power Flow"])} MW Line {random.randint(1,4)}',
-                'value': round(random.uniform(50.0, 500.0), 2),
-                'quality': random.choices(['GOOD', 'UNCERTAIN', 'INVALID'], weights=[94, 5, 1])[0],
-                'timestamp': datetime.now(timezone.utc).isoformat(),
-                'units': 'MW'
-            },
-            'location': {
-                'lat': self.site_config['lat'],
-                'lon': self.site_config['lon'],
-                'region': self.site_config['site_id'].split('_')[0]
-            },
-            'metadata': {
-                'protocol_version': 'IEC60870-6-503',
-                'message_size': random.randint(128, 512),
-                'association_active': True,
-                'roundtrip_time_ms': random.randint(5, 25),
-                'message_number': self.message_counter
-            }
+        message = self._templates[(customer, 'ANALOG_VALUE')].copy()
+        message['timestamp'] = datetime.now(timezone.utc).isoformat()
+        message['data'] = {
+            'point_id': f'MW_{pool["mw_kind"][i]}_L{pool["line"][i]}',
+            'point_name': f'{pool["mw_name"][i]} MW Line {pool["line_name"][i]}',
+            'value': pool['mw_value'][i],
+            'quality': pool['analog_quality'][i],
+            'units': UNITS_MW
+        }
+        message['metadata'] = {
+            'protocol_version': PROTOCOL_VERSION,
+            'message_size': pool['message_size'][i],
+            'association_active': True,
+            'roundtrip_time_ms': pool['roundtrip'][i],
+            'message_number': self.message_counter
         }
+        
+        return message
     
     def generate_protection_event_message(self, customer: str) -> Dict[str, Any]:
         """Generate PROTECTION_EVENT message (Alarms)"""
         self.message_counter += 1
+        pool = self._pool
+        i = self._next_pool_index()
         
-        return {
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'site_id': self.site_config['site_id'],
-            'site_name': self.site_config['display_name'],
-            'customer_id': customer,
-            'message_type': 'PROTECTION_EVENT',
-            'iccp_association': f'{self.site_config["site_id"]}-{customer}-01',
-            'data': {
-                'event_id': f'PROT_EVT_{random.randint(10000, 99999)}',
-                'event_type': random.choice(['OVERCURRENT', 'UNDERVOLTAGE', 'FREQUENCY_DEVIATION', 'LINE_FAULT']),
-                'severity': random.choices(['LOW', 'MEDIUM', 'HIGH', 'CRITICAL'], weights=[40, 35, 20, 5])[0],
-                'cleared': random.choices([True, False], weights=[85, 15])[0],
-                'timestamp': datetime.now(timezone.utc).isoformat(),
-                'equipment_affected': f'Line {random.randint(1,4)}'
-            },
-            'location': {
-                'lat': self.site_config['lat'],
-                'lon': self.site_config['lon'],
-                'region': self.site_config['site_id'].split('_')[0]
-            },
-            'metadata': {
-                'protocol_version': 'IEC60870-6-503',
-                'message_size': random.randint(200, 600),
-                'association_active': True,
-                'roundtrip_time_ms': random.randint(8, 30),
-                'message_number': self.message_counter
-            }
+        message = self._templates[(customer, 'PROTECTION_EVENT')].copy()
+        message['timestamp'] = datetime.now(timezone.utc).isoformat()
+        message['data'] = {
+            'event_id': f'PROT_EVT_{pool["event_id"][i]}',
+            'event_type': pool['event_type'][i],
+            'severity': pool['severity'][i],
+            'cleared': pool['cleared'][i],
+            'equipment_affected': f'Line {pool["line"][i]}'
         }
+        message['metadata'] = {
+            'protocol_version': PROTOCOL_VERSION,
+            'message_size': pool['event_size'][i],
+            'association_active': True,
+            'roundtrip_time_ms': pool['event_roundtrip'][i],
+            'message_number': self.message_counter
+        }
+        
+        return message
 
+    def _traceparent_headers(self, sampled: bool, topic: str) -> List[Tuple[str, bytes]]:
+        """
+        Kafka headers carrying the current transaction's trace context.
+        Empty for unsampled transactions so backend-api makes its own decision.
+        """
+        # ═══════════════════════════════════════════════════════════════
+        # CRITICAL: Manually construct W3C traceparent header
+        # Format: 00-{trace_id}-{parent_id}-{flags}
+        # This enables backend-api to continue the trace
+        # 
+        # Reference: elasticapm.get_trace_id(), elasticapm.get_transaction_id()
+        # W3C Spec: https://www.w3.org/TR/trace-context/#traceparent-header
+        # ═══════════════════════════════════════════════════════════════
+        if not sampled:
+            return []
+        
+        trace_id = elasticapm.get_trace_id()
+        transaction_id = elasticapm.get_transaction_id()
+        
+        if trace_id and transaction_id:
+            # Construct W3C compliant traceparent
+            # 00 = version, 01 = sampled flag
+            # IDs are hex strings, so ASCII-encode and join as bytes directly
+            traceparent = b'00-' + trace_id.encode('ascii') + b'-' + transaction_id.encode('ascii') + b'-01'
+            logger.debug("✓ Propagating trace: %.16s... -> %s", trace_id, topic)
+            return [('traceparent', traceparent)]
+        
+        logger.warning("⚠ No trace context for %s - distributed tracing will break", topic)
+        return []
+    
+    def _maybe_span(self, sampled: bool, ctx: SendContext):
+        """
+        Span around a Kafka send, or a no-op context when the transaction is
+        unsampled (the span would be dropped anyway, after paying for it).
+        """
+        if not sampled:
+            return nullcontext()
+        
+        # ═══════════════════════════════════════════════════════════════
+        # Create span using context manager (documented)
+        # Reference: elasticapm.capture_span(name, span_type, span_subtype, 
+        #                                     span_action, labels)
+        # ═══════════════════════════════════════════════════════════════
+        return elasticapm.capture_span(
+            name=f'send to {ctx.topic}',
+            span_type='messaging',
+            span_subtype='kafka',
+            span_action='send',
+            labels={
+                'topic': ctx.topic,
+                'message_type': ctx.message_type,
+                'message_number': str(ctx.message_number)
+            }
+        )
+    
     def send_message_with_tracing(self, message: Dict[str, Any]):
         """
         Send message to Kafka with full distributed tracing.
         Manually constructs and propagates W3C traceparent header.
         """
         message_type = message['message_type']
-        topic_map = {
-            'STATUS_POINT': 'iccp-status-points',
-            'ANALOG_VALUE': 'iccp-analog-values', 
-            'PROTECTION_EVENT': 'iccp-protection-events',
-            'ENERGY_ACCOUNTING': 'iccp-energy-accounting'
-        }
-        topic = topic_map.get(message_type, 'iccp-status-points')
-        
-        # ═══════════════════════════════════════════════════════════════════
-        # Start APM transaction using Client API (documented)
-        # Reference: Client.begin_transaction(transaction_type)
-        # ═══════════════════════════════════════════════════════════════════
-        apm_client.begin_transaction('messaging')
+        topic = TOPIC_MAP.get(message_type, 'iccp-status-points')
         
+        # Wait for an in-flight slot. Once the delivery callbacks are attached
+        # they own it; any failure before that must give it back here.
+        self._inflight.acquire()
+        handed_off = False
         try:
-            # Set transaction name (documented)
-            # Reference: elasticapm.set_transaction_name(name, override)
-            elasticapm.set_transaction_name(f'produce {topic}', override=True)
-            
-            # Add labels for filtering (documented)
-            # Reference: elasticapm.label(**kwargs)
-            elasticapm.label(
-                site_id=message['site_id'],
-                site_name=message['site_name'],
-                customer=message['customer_id'],
-                message_type=message_type,
+            # ═══════════════════════════════════════════════════════════════════
+            # Start APM transaction using Client API (documented)
+            # Reference: Client.begin_transaction(transaction_type)
+            # The transaction is ended by the delivery callbacks once the broker
+            # acknowledges (or rejects) the message.
+            # ═══════════════════════════════════════════════════════════════════
+            transaction = apm_client.begin_transaction('messaging')
+            ctx = SendContext(
+                transaction=transaction,
                 topic=topic,
-                pod=self.pod_name
+                message_type=message_type,
+                message_number=message['metadata']['message_number']
             )
             
-            # ═══════════════════════════════════════════════════════════════
-            # CRITICAL: Manually construct W3C traceparent header
-            # Format: 00-{trace_id}-{parent_id}-{flags}
-            # This enables backend-api to continue the trace
-            # 
-            # Reference: elasticapm.get_trace_id(), elasticapm.get_transaction_id()
-            # W3C Spec: https://www.w3.org/TR/trace-context/#traceparent-header
-            # ═══════════════════════════════════════════════════════════════
-            trace_id = elasticapm.get_trace_id()
-            transaction_id = elasticapm.get_transaction_id()
-            
-            kafka_headers = []
-            if trace_id and transaction_id:
-                # Construct W3C compliant traceparent
-                # 00 = version, 01 = sampled flag
-                traceparent = f"00-{trace_id}-{transaction_id}-01"
-                kafka_headers = [('traceparent', traceparent.encode('utf-8'))]
-                logger.debug(f"✓ Propagating trace: {trace_id[:16]}... -> {topic}")
-            else:
-                logger.warning(f"⚠ No trace context for {topic} - distributed tracing will break")
+            sampled = transaction is not None and transaction.is_sampled
             
-            # ═══════════════════════════════════════════════════════════════
-            # Create span using context manager (documented)
-            # Reference: elasticapm.capture_span(name, span_type, span_subtype, 
-            #                                     span_action, labels)
-            # ═══════════════════════════════════════════════════════════════
-            with elasticapm.capture_span(
-                name=f'send to {topic}',
-                span_type='messaging',
-                span_subtype='kafka',
-                span_action='send',
-                labels={
-                    'topic': topic,
-                    'message_type': message_type,
-                    'message_number': str(message['metadata']['message_number'])
-                }
-            ):
-                # Send message WITH traceparent header for distributed tracing
-                future = self.producer.send(
-                    topic,
-                    value=message,
-                    headers=kafka_headers  # ← THIS IS CRITICAL FOR DISTRIBUTED TRACING
-                )
+            try:
+                # Set transaction name (documented)
+                # Reference: elasticapm.set_transaction_name(name, override)
+                elasticapm.set_transaction_name(f'produce {topic}', override=True)
                 
-                # Wait for send confirmation
-                record_metadata = future.get(timeout=10)
+                # Add labels for filtering (documented)
+                # Reference: elasticapm.label(**kwargs)
+                # Unsampled transactions drop labels, so don't build them.
+                # sample_rate lets dashboards scale sampled counts back up.
+                if sampled:
+                    elasticapm.label(
+                        site_id=self.site_config['site_id'],
+                        site_name=self.site_config['display_name'],
+                        customer=message['customer_id'],
+                        message_type=message_type,
+                        topic=topic,
+                        pod=self.pod_name,
+                        sample_rate=TRANSACTION_SAMPLE_RATE
+                    )
                 
-                # Log successful send
-                logger.info(
-                    f"✓ {message_type} → {topic} "
-                    f"(p:{record_metadata.partition}, o:{record_metadata.offset}) "
-                    f"#{message['metadata']['message_number']}"
-                )
+                kafka_headers = self._traceparent_headers(sampled, topic)
+                
+                with self._maybe_span(sampled, ctx):
+                    # Send message WITH traceparent header for distributed tracing.
+                    # Non-blocking: the record is queued for the producer's sender thread.
+                    future = self.producer.send(
+                        topic,
+                        value=self._encode_message(message),
+                        headers=kafka_headers  # ← THIS IS CRITICAL FOR DISTRIBUTED TRACING
+                    )
+                        
+            except Exception as e:
+                logger.error("✗ Send failed: %s", e)
+                
+                # Mark transaction as failed (documented)
+                elasticapm.set_transaction_result('error', override=True)
+                elasticapm.set_transaction_outcome('failure', override=True)
+                
+                # Capture exception (documented)
+                # Reference: Client.capture_exception()
+                apm_client.capture_exception()
+                
+                # End transaction (documented)
+                # Reference: Client.end_transaction(name, result)
+                apm_client.end_transaction(f'produce {topic}', 'error')
+                
+                raise
+            
+            # Detach the transaction from this thread; the callbacks re-attach it
+            # on the producer's I/O thread when delivery completes.
+            execution_context.get_transaction(clear=True)
+            handed_off = True
+            future.add_callback(self._on_send_success, ctx).add_errback(self._on_send_error, ctx)
+        finally:
+            if not handed_off:
+                self._inflight.release()
+    
+    def _on_send_success(self, ctx: SendContext, record_metadata):
+        """Delivery callback: log the broker ack and end the APM transaction"""
+        # Lazy %-formatting: nothing is formatted when INFO is filtered out
+        logger.info(
+            "✓ %s → %s (p:%d, o:%d) #%d",
+            ctx.message_type, ctx.topic,
+            record_metadata.partition, record_metadata.offset,
+            ctx.message_number
+        )
+        
+        self._end_send_transaction(ctx, 'success', 'success')
+    
+    def _on_send_error(self, ctx: SendContext, exc: Exception):
+        """Delivery errback: log the failure and end the APM transaction"""
+        logger.error("✗ Send failed: %s", exc)
+        self._end_send_transaction(ctx, 'error', 'failure', exc)
+    
+    def _end_send_transaction(self, ctx: SendContext, result: str, outcome: str,
+                              exc: Optional[Exception] = None):
+        """
+        End a send transaction from a delivery callback and free its in-flight slot.
+        Callbacks run on the producer's I/O thread, so the transaction is
+        re-attached to that thread's context before using the APM API.
+        """
+        try:
+            execution_context.set_transaction(ctx.transaction)
             
-            # Mark transaction as successful (documented)
+            # Mark transaction outcome (documented)
             # Reference: elasticapm.set_transaction_result(result, override)
             #            elasticapm.set_transaction_outcome(outcome, override)
-            elasticapm.set_transaction_result('success', override=True)
-            elasticapm.set_transaction_outcome('success', override=True)
-                    
-        except Exception as e:
-            logger.error(f"✗ Send failed: {e}")
+            elasticapm.set_transaction_result(result, override=True)
+            elasticapm.set_transaction_outcome(outcome, override=True)
+            if exc is not None:
+                apm_client.capture_exception(exc_info=(type(exc), exc, exc.__traceback__))
+            apm_client.end_transaction(f'produce {ctx.topic}', result)
+        finally:
+            # Always free the slot: kafka-python swallows callback exceptions,
+            # so a leaked slot would eventually block the send loop for good
+            self._inflight.release()
+    
+    def send_batch_with_tracing(self, messages: List[Dict[str, Any]]):
+        """
+        Send a batch of messages under a single APM transaction.
+        Records are handed to the producer without waiting so linger_ms and
+        batch_size can coalesce them; one flush() covers the whole batch.
+        """
+        transaction = apm_client.begin_transaction('messaging-batch')
+        sampled = transaction is not None and transaction.is_sampled
+        result = 'success'
+        
+        try:
+            elasticapm.set_transaction_name('produce batch', override=True)
             
-            # Mark transaction as failed (documented)
+            if sampled:
+                elasticapm.label(
+                    site_id=self.site_config['site_id'],
+                    site_name=self.site_config['display_name'],
+                    pod=self.pod_name,
+                    batch_size=len(messages),
+                    sample_rate=TRANSACTION_SAMPLE_RATE
+                )
+            
+            # Every record in the batch continues the same trace. Each send gets
+            # its own copy: elasticapm's KafkaProducer.send wrapper appends its
+            # own traceparent header to the list it is given, in place.
+            kafka_headers = self._traceparent_headers(sampled, 'batch')
+            
+            futures = [
+                self.producer.send(
+                    TOPIC_MAP.get(message['message_type'], 'iccp-status-points'),
+                    value=self._encode_message(message),
+                    headers=list(kafka_headers)
+                )
+                for message in messages
+            ]
+            self.producer.flush()
+            
+            failed = [future for future in futures if future.failed()]
+            if failed:
+                result = 'error'
+                logger.error("✗ %d/%d sends failed: %s", len(failed), len(futures), failed[0].exception)
+                elasticapm.set_transaction_result('error', override=True)
+                elasticapm.set_transaction_outcome('failure', override=True)
+            else:
+                logger.info(
+                    "✓ Batch of %d → Kafka #%d-%d",
+                    len(messages),
+                    messages[0]['metadata']['message_number'],
+                    messages[-1]['metadata']['message_number']
+                )
+                elasticapm.set_transaction_result('success', override=True)
+                elasticapm.set_transaction_outcome('success', override=True)
+                
+        except Exception as e:
+            result = 'error'
+            logger.error("✗ Batch send failed: %s", e)
             elasticapm.set_transaction_result('error', override=True)
             elasticapm.set_transaction_outcome('failure', override=True)
-            
-            # Capture exception (documented)
-            # Reference: Client.capture_exception()
             apm_client.capture_exception()
-            
             raise
             
         finally:
-            # End transaction (documented)
-            # Reference: Client.end_transaction(name, result)
-            apm_client.end_transaction(f'produce {topic}', 'success')
+            apm_client.end_transaction('produce batch', result)
     
-    def generate_and_send_message(self):
-        """Generate random message and send with tracing"""
+    def generate_message(self) -> Dict[str, Any]:
+        """Generate a message for a random customer and message type"""
         customer = random.choice(self.site_config['customers'])
-        message_types = ['STATUS_POINT', 'ANALOG_VALUE', 'PROTECTION_EVENT', 'ENERGY_ACCOUNTING']
-        weights = [50, 30, 15, 5]
-        message_type = random.choices(message_types, weights=weights)[0]
+        message_type = random.choices(MESSAGE_TYPES, cum_weights=MESSAGE_TYPE_CUM_WEIGHTS)[0]
         
         # Generate appropriate message type
-        if message_type == 'STATUS_POINT':
-            message = self.generate_status_point_message(customer)
-        elif message_type == 'ANALOG_VALUE':
-            message = self.generate_analog_value_message(customer)
-        elif message_type == 'PROTECTION_EVENT':
-            message = self.generate_protection_event_message(customer)
-        else:
-            message = self.generate_status_point_message(customer)
-        
+        return self._generators[message_type](customer)
+    
+    def generate_and_send_message(self):
+        """Generate random message and send with tracing"""
         # Send with full APM tracing
-        self.send_message_with_tracing(message)
+        self.send_message_with_tracing(self.generate_message())
+    
+    def generate_and_send_batch(self) -> int:
+        """Generate BATCH_MESSAGES messages and send them as one traced batch"""
+        messages = [self.generate_message() for _ in range(self.batch_messages)]
+        self.send_batch_with_tracing(messages)
+        return len(messages)
     
     def run_simulation(self):
         """Main simulation loop"""
         logger.info(f"🚀 Starting ICCP simulation loop")
-        logger.info(f"Message frequency: {self.site_config['message_frequency']}s ± 0.3s")
+        if self.batch_mode:
+            logger.info(f"Batch mode: {self.batch_messages} messages per batch, no delay")
+        else:
+            logger.info(f"Message frequency: {self.site_config['message_frequency']}s ± 0.3s")
         logger.info(f"Distributed tracing: traceparent headers enabled")
         
         message_count = 0
@@ -389,14 +692,23 @@ class ICCPSimulator:
         
         while True:
             try:
-                self.generate_and_send_message()
-                message_count += 1
+                if self.batch_mode:
+                    sent = self.generate_and_send_batch()
+                else:
+                    self.generate_and_send_message()
+                    sent = 1
+                previous_count = message_count
+                message_count += sent
                 
                 # Log throughput stats every 100 messages
-                if message_count % 100 == 0:
+                if message_count // 100 > previous_count // 100:
                     elapsed = time.time() - start_time
                     rate = message_count / elapsed
-                    logger.info(f"📊 Sent {message_count} messages ({rate:.1f} msg/sec)")
+                    logger.info("📊 Sent %d messages (%.1f msg/sec)", message_count, rate)
+                
+                # Batch mode is a throughput test: send the next batch straight away
+                if self.batch_mode:
+                    continue
                 
                 # Sleep with jitter
                 sleep_time = self.site_config['message_frequency'] + random.uniform(-0.3, 0.3)